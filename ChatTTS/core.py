@@ -130,7 +130,11 @@ class Chat:
         device: Optional[torch.device] = None,
         coef: Optional[torch.Tensor] = None,
         use_flash_attn=False,
+        quantize_heads=False,
     ) -> bool:
+        # only takes effect before the first CUDA allocation. expandable segments
+        # limit fragmentation as the gpt kv cache, dvae and vocos interleave
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
         download_path = self.download_models(source, force_redownload, custom_path)
         if download_path is None:
             return False
@@ -139,6 +143,7 @@ class Chat:
             compile=compile,
             coef=coef,
             use_flash_attn=use_flash_attn,
+            quantize_heads=quantize_heads,
             **{
                 k: os.path.join(download_path, v)
                 for k, v in asdict(self.config.path).items()
@@ -246,6 +251,7 @@ class Chat:
         compile: bool = True,
         coef: Optional[str] = None,
         use_flash_attn=False,
+        quantize_heads=False,
     ):
         if device is None:
             device = select_device()
@@ -298,7 +304,9 @@ class Chat:
         ).eval()
         assert gpt_ckpt_path, "gpt_ckpt_path should not be None"
         gpt.from_pretrained(gpt_ckpt_path)
-        gpt.prepare(compile=compile and "cuda" in str(device))
+        gpt.prepare(
+            compile=compile and "cuda" in str(device), quantize_heads=quantize_heads
+        )
         self.gpt = gpt
         spk_stat_path = os.path.join(os.path.dirname(gpt_ckpt_path), "spk_stat.pt")
         assert os.path.exists(spk_stat_path), f"Missing spk_stat.pt: {spk_stat_path}"
@@ -509,7 +517,7 @@ class Chat:
                 emb, params.spk_emb, input_ids, self.gpt.device_gpt
             )
 
-        num_code = int(gpt.emb_code[0].num_embeddings - 1)
+        num_code = int(gpt.num_audio_tokens - 1)
 
         logits_warpers, logits_processors = gen_logits(
             num_code=num_code,
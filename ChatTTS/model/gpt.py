@@ -6,12 +6,9 @@ import gc
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-import torch.nn.utils.parametrize as P
-from torch.nn.utils.parametrizations import weight_norm
 from tqdm import tqdm
 from transformers import LlamaModel, LlamaConfig, LogitsWarper
-from transformers.cache_utils import Cache
+from transformers.cache_utils import Cache, DynamicCache, StaticCache
 from transformers.modeling_outputs import BaseModelOutputWithPast
 from transformers.utils import is_flash_attn_2_available
 
@@ -35,54 +32,118 @@ class GPT(nn.Module):
         self.logger = logger
 
         self.device = device
-        self.device_gpt = device if "mps" not in str(device) else torch.device("cpu")
+        # a torch.device, so that per-step comparisons and `.to` calls don't reparse it
+        self.device_gpt = torch.device(device if "mps" not in str(device) else "cpu")
+        self._same_device = str(self.device) == str(self.device_gpt)
 
         self.num_vq = num_vq
         self.num_audio_tokens = num_audio_tokens
 
         self.use_flash_attn = use_flash_attn
 
+        self._compiled_decode_step = self._decode_step
+        # reading finish back is free on cpu, so only batch the check on devices
+        self._finish_check_interval = 1 if "cpu" in str(self.device_gpt) else 8
+
+        # static kv buffers only pay off once the model is compiled. the last one
+        # is kept so that calls of the same shape reuse its addresses
+        self._use_static_cache = False
+        self._static_cache: Optional[StaticCache] = None
+
         self.gpt, self.llama_config = self._build_llama(gpt_config, self.device_gpt)
         self.is_te_llama = False
         self.model_dim = int(self.gpt.config.hidden_size)
-        self.emb_code = nn.ModuleList(
-            [
-                nn.Embedding(
-                    num_audio_tokens,
-                    self.model_dim,
-                    device=self.device_gpt,
-                )
-                for _ in range(num_vq)
-            ],
+        # the num_vq code tables concatenated, so that one gather-sum serves all
+        # of them. checkpoints keep one emb_code.{i} table per vq
+        self.emb_code_fused = nn.EmbeddingBag(
+            num_audio_tokens * num_vq,
+            self.model_dim,
+            mode="sum",
+            device=self.device_gpt,
         )
         self.emb_text = nn.Embedding(
             num_text_tokens, self.model_dim, device=self.device_gpt
         )
+        # offsets of each vq into the fused code embedding
+        self.register_buffer(
+            "vq_offsets",
+            torch.arange(num_vq, device=self.device_gpt) * num_audio_tokens,
+            persistent=False,
+        )
 
-        self.head_text = weight_norm(
-            nn.Linear(
-                self.model_dim,
-                num_text_tokens,
-                bias=False,
-                device=device,
-            ),
-            name="weight",
+        # the heads hold the materialized weight_norm weight, so inference does
+        # not recompute g * v / ||v||. checkpoints keep g and v
+        self.head_text = nn.Linear(
+            self.model_dim,
+            num_text_tokens,
+            bias=False,
+            device=device,
         )
-        self.head_code = nn.ModuleList(
-            [
-                weight_norm(
-                    nn.Linear(
-                        self.model_dim,
-                        num_audio_tokens,
-                        bias=False,
-                        device=device,
-                    ),
-                    name="weight",
-                )
-                for _ in range(self.num_vq)
-            ],
+        # the num_vq heads stacked, so that one GEMM yields all code logits.
+        # weight_norm is per output row, so stacking g and v keeps it exact
+        self.head_code_fused = nn.Linear(
+            self.model_dim,
+            num_audio_tokens * num_vq,
+            bias=False,
+            device=device,
         )
 
+        self._register_state_dict_hook(self._split_checkpoint)
+        self._register_load_state_dict_pre_hook(self._fuse_checkpoint, with_module=True)
+
+    # weight-normed heads of the checkpoint
+    _weight_norm_heads = ("head_text", "head_code_fused")
+    # per vq checkpoint entries and the fused parameter they are concatenated into
+    _fused_keys = (
+        ("emb_code.{}.weight", "emb_code_fused.weight"),
+        (
+            "head_code.{}.parametrizations.weight.original0",
+            "head_code_fused.parametrizations.weight.original0",
+        ),
+        (
+            "head_code.{}.parametrizations.weight.original1",
+            "head_code_fused.parametrizations.weight.original1",
+        ),
+    )
+
+    @staticmethod
+    def _fuse_checkpoint(module: "GPT", state_dict: dict, prefix: str, *args):
+        """
+        load_state_dict pre-hook, concat the per vq entries of the checkpoint
+        and materialize the weight_norm of the heads
+        """
+        for split, fused in module._fused_keys:
+            keys = [prefix + split.format(i) for i in range(module.num_vq)]
+            if keys[0] in state_dict:
+                state_dict[prefix + fused] = torch.cat(
+                    [state_dict.pop(k) for k in keys]
+                )
+        for head in module._weight_norm_heads:
+            name = f"{prefix}{head}.parametrizations.weight.original"
+            if name + "0" in state_dict:
+                g, v = state_dict.pop(name + "0"), state_dict.pop(name + "1")
+                state_dict[f"{prefix}{head}.weight"] = torch._weight_norm(v, g, 0)
+
+    @staticmethod
+    def _split_checkpoint(module: "GPT", state_dict: dict, prefix: str, *args):
+        """
+        state_dict hook, keep the checkpoint layout of weight_norm g and v
+        and one entry per vq
+        """
+        for head in module._weight_norm_heads:
+            if f"{prefix}{head}.weight" not in state_dict:
+                continue
+            weight = state_dict.pop(f"{prefix}{head}.weight")
+            name = f"{prefix}{head}.parametrizations.weight.original"
+            # the same split as weight_norm's right_inverse
+            state_dict[name + "0"] = torch.norm_except_dim(weight, 2, 0)
+            state_dict[name + "1"] = weight
+        for split, fused in module._fused_keys:
+            if prefix + fused not in state_dict:
+                continue
+            for i, t in enumerate(state_dict.pop(prefix + fused).chunk(module.num_vq)):
+                state_dict[prefix + split.format(i)] = t
+
     def from_pretrained(self, file_path: str):
 
         self.load_state_dict(torch.load(file_path, weights_only=True, mmap=True))
@@ -131,6 +192,8 @@ class GPT(nn.Module):
                 "enabling flash_attention_2 may make gpt be even slower"
             )
         else:
+            # LlamaModel already picks sdpa when torch supports it, so the
+            # fused attention kernels need no explicit attn_implementation
             llama_config = LlamaConfig(**config)
 
         model = LlamaModel(llama_config)
@@ -138,13 +201,49 @@ class GPT(nn.Module):
 
         return model.to(device), llama_config
 
-    def prepare(self, compile=False):
+    def prepare(self, compile=False, quantize_heads=False):
         if self.use_flash_attn and is_flash_attn_2_available():
             self.gpt = self.gpt.to(dtype=torch.float16)
+        elif (
+            not self.is_te_llama
+            and "cuda" in str(self.device_gpt)
+            and torch.cuda.is_bf16_supported()
+        ):
+            # decoding is bandwidth bound, bf16 halves the weight bytes moved
+            self.gpt = self.gpt.to(dtype=torch.bfloat16)
+        if quantize_heads and "cpu" in str(self.device):
+            if compile:
+                # quantized linears break the fullgraph compiled step
+                self.logger.warning("heads are not quantized when compiling.")
+            else:
+                try:
+                    # int8 heads halve the bytes moved per step and use VNNI on x86
+                    qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+                    torch.ao.quantization.quantize_dynamic(
+                        self,
+                        {"head_text": qconfig, "head_code_fused": qconfig},
+                        dtype=torch.qint8,
+                        inplace=True,
+                    )
+                    self.emb_code_fused.weight.data = (
+                        self.emb_code_fused.weight.data.to(torch.bfloat16)
+                    )
+                except (RuntimeError, AssertionError) as e:
+                    self.logger.warning(
+                        f"quantize failed: {e}. fallback to float heads."
+                    )
         if compile and not self.is_te_llama:
             try:
+                import torch._inductor.config as inductor_config
+
+                inductor_config.coordinate_descent_tuning = True
+                inductor_config.triton.unique_kernel_names = True
                 self.compile(backend="inductor", dynamic=True)
-                self.gpt.compile(backend="inductor", dynamic=True)
+                # shapes are static thanks to StaticCache, so cuda graphs can be reused
+                self._compiled_decode_step = torch.compile(
+                    self._decode_step, mode="reduce-overhead", fullgraph=True
+                )
+                self._use_static_cache = True
             except RuntimeError as e:
                 self.logger.warning(f"compile failed: {e}. fallback to normal mode.")
 
@@ -161,159 +260,159 @@ class GPT(nn.Module):
         get_emb
         """
 
-        emb_text: torch.Tensor = self.emb_text(
-            input_ids[text_mask].narrow(1, 0, 1).squeeze_(1).to(self.device_gpt)
-        )
+        input_ids = input_ids.to(self.device_gpt)
+        text_mask = text_mask.to(self.device_gpt)
 
-        text_mask_inv = text_mask.logical_not().to(self.device_gpt)
-        masked_input_ids: torch.Tensor = input_ids[text_mask_inv].to(self.device_gpt)
+        # one gather over the whole batch, code ids are in range of emb_text too
+        emb_text: torch.Tensor = self.emb_text(input_ids.narrow(2, 0, 1).squeeze(2))
 
-        emb_code = [
-            self.emb_code[i](masked_input_ids[:, i]) for i in range(self.num_vq)
-        ]
-        emb_code = torch.stack(emb_code, 2).sum(2)
+        if text_mask.all():
+            return emb_text
 
-        emb = torch.zeros(
-            (input_ids.shape[:-1]) + (emb_text.shape[-1],),
-            device=emb_text.device,
-            dtype=emb_text.dtype,
-        )
-        emb[text_mask] = emb_text
-        emb[text_mask_inv] = emb_code.to(emb.dtype)
+        text_mask = text_mask.unsqueeze(-1)
+        # text ids may exceed num_audio_tokens, mask them out before the lookup
+        code_ids = input_ids.masked_fill(text_mask, 0)
+        emb_code = self._emb_code(code_ids)
+
+        emb = torch.where(text_mask, emb_text, emb_code.to(emb_text.dtype))
 
-        del emb_text, emb_code, text_mask_inv
+        del emb_text, emb_code, code_ids
 
         return emb
 
+    def _to_gpt(
+        self, t: torch.Tensor, dtype: Optional[torch.dtype] = None
+    ) -> torch.Tensor:
+        """
+        move t to device_gpt, skipping the dispatch if it is already there
+        """
+        if t.device == self.device_gpt and (dtype is None or t.dtype == dtype):
+            return t
+        return t.to(self.device_gpt, dtype=dtype, non_blocking=True)
+
+    def _emb_code(self, input_ids: torch.Tensor) -> torch.Tensor:
+        """
+        sum of the num_vq code embeddings of input_ids (..., num_vq)
+        """
+        emb: torch.Tensor = self.emb_code_fused(
+            input_ids.add(self.vq_offsets).reshape(-1, self.num_vq)
+        )
+        return emb.view(*input_ids.shape[:-1], emb.size(-1))
+
+    def _get_static_cache(self, batch_size: int, max_cache_len: int) -> StaticCache:
+        """
+        reuse the kv cache of the last call if the shape matches,
+        otherwise replace it so that only one is ever kept alive
+        """
+        # round up so that calls of similar length share one cache
+        max_cache_len = (max_cache_len + 255) // 256 * 256
+        cache = self._static_cache
+        if (
+            cache is not None
+            and cache.max_batch_size == batch_size
+            and cache.max_cache_len == max_cache_len
+        ):
+            cache.reset()
+            return cache
+        # drop the old buffers before allocating the new ones
+        self._static_cache = cache = None
+        self._static_cache = StaticCache(
+            config=self.gpt.config,
+            max_batch_size=batch_size,
+            max_cache_len=max_cache_len,
+            device=self.device_gpt,
+            dtype=self.gpt.dtype,
+        )
+        return self._static_cache
+
     @dataclass(repr=False, eq=False)
     class _GenerationInputs:
         position_ids: torch.Tensor
         cache_position: torch.Tensor
         use_cache: bool
         input_ids: Optional[torch.Tensor] = None
-        past_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None
+        past_key_values: Optional[Cache] = None
         attention_mask: Optional[torch.Tensor] = None
         inputs_embeds: Optional[torch.Tensor] = None
 
-        def to(self, device: torch.device, dtype: torch.dtype):
-            if self.attention_mask is not None:
-                self.attention_mask = self.attention_mask.to(device, dtype=dtype)
-            if self.position_ids is not None:
-                self.position_ids = self.position_ids.to(device, dtype=dtype)
-            if self.inputs_embeds is not None:
-                self.inputs_embeds = self.inputs_embeds.to(device, dtype=dtype)
-            if self.cache_position is not None:
-                self.cache_position = self.cache_position.to(device, dtype=dtype)
-
     def _prepare_generation_inputs(
         self,
         input_ids: torch.Tensor,
-        past_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
+        past_length: int,
+        cache_position: torch.Tensor,
+        position_ids: torch.Tensor,
+        past_key_values: Optional[Cache] = None,
         attention_mask: Optional[torch.Tensor] = None,
-        inputs_embeds: Optional[torch.Tensor] = None,
-        cache_position: Optional[torch.Tensor] = None,
-        position_ids: Optional[torch.Tensor] = None,
         use_cache=True,
     ) -> _GenerationInputs:
-        # With static cache, the `past_key_values` is None
-        # TODO joao: standardize interface for the different Cache classes and remove of this if
-        has_static_cache = False
-        if past_key_values is None:
-            if hasattr(self.gpt.layers[0], "self_attn"):
-                past_key_values = getattr(
-                    self.gpt.layers[0].self_attn, "past_key_value", None
-                )
-            has_static_cache = past_key_values is not None
-
-        past_length = 0
-        if past_key_values is not None:
-            if isinstance(past_key_values, Cache):
-                past_length = (
-                    int(cache_position[0])
-                    if cache_position is not None
-                    else past_key_values.get_seq_length()
-                )
-                max_cache_length = past_key_values.get_max_length()
-                cache_length = (
-                    past_length
-                    if max_cache_length is None
-                    else min(max_cache_length, past_length)
-                )
-            # TODO joao: remove this `else` after `generate` prioritizes `Cache` objects
-            else:
-                cache_length = past_length = past_key_values[0][0].shape[2]
-                max_cache_length = None
-
-            # Keep only the unprocessed tokens:
-            # 1 - If the length of the attention_mask exceeds the length of input_ids, then we are in a setting where
-            # some of the inputs are exclusively passed as part of the cache (e.g. when passing input_embeds as
-            # input)
-            if (
-                attention_mask is not None
-                and attention_mask.shape[1] > input_ids.shape[1]
-            ):
-                start = attention_mask.shape[1] - past_length
-                input_ids = input_ids.narrow(1, -start, start)
-            # 2 - If the past_length is smaller than input_ids', then input_ids holds all input tokens. We can discard
-            # input_ids based on the past_length.
-            elif past_length < input_ids.shape[1]:
-                input_ids = input_ids.narrow(
-                    1, past_length, input_ids.size(1) - past_length
-                )
-            # 3 - Otherwise (past_length >= input_ids.shape[1]), let's assume input_ids only has unprocessed tokens.
-
-            # If we are about to go beyond the maximum cache length, we need to crop the input attention mask.
-            if (
-                max_cache_length is not None
-                and attention_mask is not None
-                and cache_length + input_ids.shape[1] > max_cache_length
-            ):
-                attention_mask = attention_mask.narrow(
-                    1, -max_cache_length, max_cache_length
-                )
-
-        if attention_mask is not None and position_ids is None:
-            # create position_ids on the fly for batch generation
-            position_ids = attention_mask.long().cumsum(-1) - 1
-            position_ids.masked_fill_(attention_mask.eq(0), 1)
-            if past_key_values:
-                position_ids = position_ids.narrow(
-                    1, -input_ids.shape[1], input_ids.shape[1]
-                )
-
-        input_length = (
-            position_ids.shape[-1] if position_ids is not None else input_ids.shape[-1]
-        )
-        if cache_position is None:
-            cache_position = torch.arange(
-                past_length, past_length + input_length, device=input_ids.device
-            )
-        else:
-            cache_position = cache_position.narrow(0, -input_length, input_length)
-
-        if has_static_cache:
-            past_key_values = None
+        # Keep only the unprocessed tokens. `past_length` is tracked by the caller
+        # so that no device readback of the cache length is needed.
+        # input_ids is laid out as (b, num_vq, t)
+        input_length = input_ids.size(2) - past_length
 
+        # `cache_position` and `position_ids` are preallocated for the whole
+        # generation, slice the positions written in this step
         model_inputs = self._GenerationInputs(
-            position_ids=position_ids,
-            cache_position=cache_position,
+            position_ids=position_ids.narrow(1, past_length, input_length),
+            cache_position=cache_position.narrow(0, past_length, input_length),
             use_cache=use_cache,
         )
 
-        # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and past_key_values is None:
-            model_inputs.inputs_embeds = inputs_embeds
-        else:
-            # The `contiguous()` here is necessary to have a static stride during decoding. torchdynamo otherwise
-            # recompiles graphs as the stride of the inputs is a guard. Ref: https://github.com/huggingface/transformers/pull/29114
-            # TODO: use `next_tokens` directly instead.
-            model_inputs.input_ids = input_ids.contiguous()
+        # input_ids only feed the embedding lookups outside the compiled step,
+        # which accept any stride, so no `contiguous()` copy is needed here
+        model_inputs.input_ids = input_ids.narrow(2, past_length, input_length)
 
         model_inputs.past_key_values = past_key_values
+        if not isinstance(past_key_values, StaticCache) and attention_mask is not None:
+            # without a static cache the mask must match the processed length
+            attention_mask = attention_mask.narrow(1, 0, input_ids.size(2))
+        # with a static cache the full-length mask keeps its shape stable across steps
         model_inputs.attention_mask = attention_mask
 
         return model_inputs
 
+    def _decode_step(
+        self,
+        inputs_embeds: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+        position_ids: torch.Tensor,
+        cache_position: torch.Tensor,
+        past_key_values: Optional[Cache],
+        use_cache: bool,
+        infer_text: bool,
+        output_attentions: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[Tuple[torch.FloatTensor, ...]]]:
+        """
+        run gpt and the heads for one step,
+        return last hidden states, next token logits and attentions
+        """
+        outputs: BaseModelOutputWithPast = self.gpt(
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            inputs_embeds=inputs_embeds,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            cache_position=cache_position,
+        )
+        # only the last token is sampled, skip the rest of the sequence in the heads.
+        # the heads and the sampling stay in fp32
+        hidden_states = (
+            outputs.last_hidden_state.narrow(1, -1, 1)
+            .squeeze(1)
+            .to(self.device, dtype=torch.float)
+        )  # 🐻
+
+        if infer_text:
+            logits: torch.Tensor = self.head_text(hidden_states)
+        else:
+            # (b, num_vq, num_audio_tokens)
+            logits = self.head_code_fused(hidden_states).view(
+                hidden_states.size(0), self.num_vq, self.num_audio_tokens
+            )
+
+        return hidden_states, logits, outputs.attentions
+
     @dataclass(repr=False, eq=False)
     class GenerationOutputs:
         ids: List[torch.Tensor]
@@ -334,17 +433,25 @@ class GPT(nn.Module):
         hiddens: List[torch.Tensor],
         infer_text: bool,
     ) -> GenerationOutputs:
-        inputs_ids = [
-            inputs_ids[idx].narrow(0, start_idx, i) for idx, i in enumerate(end_idx)
-        ]
+        # read all the lengths back at once, narrowing by a device scalar
+        # would sync once per sample. the slices below are then plain views
+        lengths: List[int] = end_idx.tolist()
+
+        # inputs_ids is laid out as (b, num_vq, t), return (t, num_vq) per sample
         if infer_text:
-            inputs_ids = [i.narrow(1, 0, 1).squeeze_(1) for i in inputs_ids]
+            inputs_ids = [
+                inputs_ids[idx, 0].narrow(0, start_idx, i)
+                for idx, i in enumerate(lengths)
+            ]
+        else:
+            inputs_ids = [
+                inputs_ids[idx].narrow(1, start_idx, i).t()
+                for idx, i in enumerate(lengths)
+            ]
 
         if len(hiddens) > 0:
             hiddens = torch.stack(hiddens, 1)
-            hiddens = [
-                hiddens[idx].narrow(0, 0, i) for idx, i in enumerate(end_idx.int())
-            ]
+            hiddens = [hiddens[idx].narrow(0, 0, i) for idx, i in enumerate(lengths)]
 
         return self.GenerationOutputs(
             ids=inputs_ids,
@@ -378,10 +485,13 @@ class GPT(nn.Module):
         hiddens = []
         stream_iter = 0
 
+        # keep all the bookkeeping on device_gpt so that no per-step transfer is needed
         start_idx, end_idx = inputs_ids.shape[1], torch.zeros(
-            inputs_ids.shape[0], device=inputs_ids.device, dtype=torch.long
+            inputs_ids.shape[0], device=self.device_gpt, dtype=torch.long
+        )
+        finish = torch.zeros(
+            inputs_ids.shape[0], device=self.device_gpt, dtype=torch.bool
         )
-        finish = torch.zeros(inputs_ids.shape[0], device=inputs_ids.device).bool()
 
         old_temperature = temperature
 
@@ -392,31 +502,19 @@ class GPT(nn.Module):
             .view(-1, 1)
         )
 
-        attention_mask_cache = torch.ones(
+        progress = inputs_ids.size(1)
+        # pre-allocate inputs_ids, only [..., :progress] is ever read so skip zeroing.
+        # (b, num_vq, t) layout so that the (b n) t view for the processors is free
+        inputs_ids_buf = inputs_ids.new_empty(
             (
-                inputs_ids.shape[0],
-                inputs_ids.shape[1] + max_new_token,
-            ),
-            dtype=torch.bool,
-            device=inputs_ids.device,
-        )
-        if attention_mask is not None:
-            attention_mask_cache.narrow(1, 0, attention_mask.shape[1]).copy_(
-                attention_mask
+                inputs_ids.size(0),
+                inputs_ids.size(2),
+                progress + max_new_token,
             )
-
-        progress = inputs_ids.size(1)
-        # pre-allocate inputs_ids
-        inputs_ids_buf = torch.zeros(
-            inputs_ids.size(0),
-            progress + max_new_token,
-            inputs_ids.size(2),
-            dtype=inputs_ids.dtype,
-            device=inputs_ids.device,
         )
-        inputs_ids_buf.narrow(1, 0, progress).copy_(inputs_ids)
+        inputs_ids_buf.narrow(2, 0, progress).copy_(inputs_ids.permute(0, 2, 1))
         del inputs_ids
-        inputs_ids = inputs_ids_buf.narrow(1, 0, progress)
+        inputs_ids = inputs_ids_buf.narrow(2, 0, progress)
 
         pbar: Optional[tqdm] = None
 
@@ -427,100 +525,135 @@ class GPT(nn.Module):
                 bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}(max) [{elapsed}, {rate_fmt}{postfix}]",
             )
 
-        past_key_values = None
+        # attentions can't be returned from the fullgraph compiled step
+        use_compiled_step = (
+            self._use_static_cache and not self.is_te_llama and not return_attn
+        )
+        decode_step = self._decode_step
+        compiled_decode_step = self._compiled_decode_step
+
+        past_key_values: Optional[Cache] = None
+        if use_compiled_step:
+            # fixed-size KV buffers, written in place at `cache_position` each step
+            past_key_values = self._get_static_cache(
+                inputs_ids.size(0), progress + max_new_token
+            )
+        elif not self.is_te_llama:
+            # eager steps only attend over the processed tokens
+            past_key_values = DynamicCache()
+
+        cache_position = torch.arange(
+            progress + max_new_token, dtype=torch.long, device=self.device_gpt
+        )
+        # with a static cache the mask spans the whole cache, so that every call
+        # of the same length bucket passes the same shape
+        mask_length = (
+            past_key_values.max_cache_len
+            if isinstance(past_key_values, StaticCache)
+            else progress + max_new_token
+        )
+        attention_mask_cache = torch.ones(
+            (inputs_ids.size(0), mask_length),
+            dtype=torch.bool,
+            device=inputs_ids.device,
+        )
+        if attention_mask is not None:
+            attention_mask_cache.narrow(1, 0, attention_mask.shape[1]).copy_(
+                attention_mask
+            )
+        # converted once here instead of on every step
+        attention_mask_cache = self._to_gpt(attention_mask_cache, self.gpt.dtype)
+        # create position_ids once for batch generation
+        position_ids = attention_mask_cache.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask_cache.eq(0), 1)
+
+        # bind what is read on every step to locals, attribute lookups add up
+        # over thousands of steps, and `self.gpt.dtype` walks the parameters
+        prepare_generation_inputs = self._prepare_generation_inputs
+        emb_text = self.emb_text
+        emb_code = self._emb_code
+        to_gpt = self._to_gpt
+        gpt_dtype = self.gpt.dtype
+        num_vq = self.num_vq
+        device = self.device
+        device_gpt = self.device_gpt
+        same_device = self._same_device
+        finish_check_interval = self._finish_check_interval
 
         for i in range(max_new_token):
 
-            model_input = self._prepare_generation_inputs(
+            model_input = prepare_generation_inputs(
                 inputs_ids,
+                0 if i == 0 or past_key_values is None else progress - 1,
+                cache_position,
+                position_ids,
                 past_key_values,
-                attention_mask_cache.narrow(1, 0, inputs_ids.shape[1]),
-                use_cache=not self.is_te_llama,
+                attention_mask_cache,
+                use_cache=past_key_values is not None,
             )
 
             if i > 0:
-                del emb
-                inputs_ids_emb = model_input.input_ids.to(self.device_gpt)
+                inputs_ids_emb = to_gpt(model_input.input_ids)
                 if infer_text:
-                    emb: torch.Tensor = self.emb_text(inputs_ids_emb[:, :, 0])
+                    emb: torch.Tensor = emb_text(inputs_ids_emb[:, 0])
                 else:
-                    code_emb = [
-                        self.emb_code[i](inputs_ids_emb[:, :, i])
-                        for i in range(self.num_vq)
-                    ]
-                    emb = torch.stack(code_emb, 3).sum(3)
-                del inputs_ids_emb, model_input.input_ids
-            model_input.inputs_embeds = emb
-
-            model_input.to(self.device_gpt, self.gpt.dtype)
-
-            outputs: BaseModelOutputWithPast = self.gpt(
-                attention_mask=model_input.attention_mask,
-                position_ids=model_input.position_ids,
-                past_key_values=model_input.past_key_values,
-                inputs_embeds=model_input.inputs_embeds,
-                use_cache=model_input.use_cache,
-                output_attentions=return_attn,
-                cache_position=model_input.cache_position,
+                    emb = emb_code(inputs_ids_emb.permute(0, 2, 1))
+            model_input.inputs_embeds = to_gpt(emb, gpt_dtype)
+
+            step_inputs = (
+                model_input.inputs_embeds,
+                model_input.attention_mask,
+                model_input.position_ids,
+                model_input.cache_position,
+                model_input.past_key_values,
+                model_input.use_cache,
+                infer_text,
+                return_attn,
             )
-            del_all(model_input)
-            attentions.append(outputs.attentions)
-            hidden_states = outputs.last_hidden_state.to(
-                self.device, dtype=torch.float
-            )  # 🐻
-            past_key_values = outputs.past_key_values
-            del_all(outputs)
-            if return_hidden:
-                hiddens.append(hidden_states.narrow(1, -1, 1).squeeze_(1))
-
-            with P.cached():
-                if infer_text:
-                    logits: torch.Tensor = self.head_text(hidden_states)
-                else:
-                    # logits = torch.stack([self.head_code[i](hidden_states) for i in range(self.num_vq)], 3)
-                    logits = torch.empty(
-                        hidden_states.size(0),
-                        hidden_states.size(1),
-                        self.num_audio_tokens,
-                        self.num_vq,
-                        dtype=torch.float,
-                        device=self.device,
+            # prefill has a different shape, only the steady-state step is compiled
+            compiled = i > 0 and use_compiled_step
+            if not compiled:
+                hidden_states, logits, attn = decode_step(*step_inputs)
+            elif i > 1:
+                hidden_states, logits, attn = compiled_decode_step(*step_inputs)
+            else:
+                try:
+                    # torch.compile is lazy, tracing fails on the first call
+                    hidden_states, logits, attn = compiled_decode_step(*step_inputs)
+                except torch._dynamo.exc.TorchDynamoException as e:
+                    self.logger.warning(
+                        f"compile failed: {e}. fallback to normal mode."
                     )
-                    for num_vq_iter in range(self.num_vq):
-                        x: torch.Tensor = self.head_code[num_vq_iter](hidden_states)
-                        logits[..., num_vq_iter] = x
-                        del x
-
-            del hidden_states
+                    self._compiled_decode_step = decode_step
+                    self._use_static_cache = False
+                    compiled = use_compiled_step = False
+                    hidden_states, logits, attn = decode_step(*step_inputs)
+            if return_attn:
+                attentions.append(attn)
+            if return_hidden:
+                # cuda graph replays overwrite the compiled step's output buffers
+                hiddens.append(hidden_states.clone() if compiled else hidden_states)
 
-            # logits = logits[:, -1].float()
-            logits = logits.narrow(1, -1, 1).squeeze_(1).float()
+            logits = logits.float()
 
             if not infer_text:
-                # logits = rearrange(logits, "b c n -> (b n) c")
-                logits = logits.permute(0, 2, 1)
+                # logits = rearrange(logits, "b n c -> (b n) c")
                 logits = logits.reshape(-1, logits.size(2))
-                # logits_token = rearrange(inputs_ids[:, start_idx:], "b c n -> (b n) c")
-                inputs_ids_sliced = inputs_ids.narrow(
-                    1,
+                # logits_token = rearrange(inputs_ids[..., start_idx:], "b n c -> (b n) c")
+                # a view, as the leading dims of the buffer are contiguous
+                logits_token = inputs_ids.narrow(
+                    2,
                     start_idx,
-                    inputs_ids.size(1) - start_idx,
-                ).permute(0, 2, 1)
-                logits_token = inputs_ids_sliced.reshape(
-                    inputs_ids_sliced.size(0) * inputs_ids_sliced.size(1),
-                    -1,
-                ).to(self.device)
-                del inputs_ids_sliced
+                    progress - start_idx,
+                ).flatten(0, 1)
             else:
-                logits_token = (
-                    inputs_ids.narrow(
-                        1,
-                        start_idx,
-                        inputs_ids.size(1) - start_idx,
-                    )
-                    .narrow(2, 0, 1)
-                    .to(self.device)
+                logits_token = inputs_ids[:, 0].narrow(
+                    1,
+                    start_idx,
+                    progress - start_idx,
                 )
+            if not same_device:
+                logits_token = logits_token.to(device, non_blocking=True)
 
             logits /= temperature
 
@@ -530,32 +663,28 @@ class GPT(nn.Module):
             for logitsWarpers in logits_warpers:
                 logits = logitsWarpers(logits_token, logits)
 
-            del logits_token
-
             if i < min_new_token:
                 logits[:, eos_token] = -torch.inf
 
-            scores = F.softmax(logits, dim=-1)
-
-            del logits
+            # multinomial accepts unnormalized weights, so a stable in-place exp
+            # replaces softmax without another vocab-sized allocation
+            logits.sub_(logits.amax(-1, keepdim=True)).exp_()
 
-            idx_next = torch.multinomial(scores, num_samples=1).to(finish.device)
-
-            del scores
+            idx_next = torch.multinomial(logits, num_samples=1)
+            if not same_device:
+                idx_next = idx_next.to(device_gpt)
 
             if not infer_text:
                 # idx_next = rearrange(idx_next, "(b n) 1 -> b n", n=self.num_vq)
-                idx_next = idx_next.view(-1, self.num_vq)
+                idx_next = idx_next.view(-1, num_vq)
                 finish_or = idx_next.eq(eos_token).any(1)
                 finish.logical_or_(finish_or)
-                del finish_or
-                inputs_ids_buf.narrow(1, progress, 1).copy_(idx_next.unsqueeze_(1))
+                inputs_ids_buf.narrow(2, progress, 1).copy_(idx_next.unsqueeze_(2))
             else:
                 finish_or = idx_next.eq(eos_token).any(1)
                 finish.logical_or_(finish_or)
-                del finish_or
-                inputs_ids_buf.narrow(1, progress, 1).copy_(
-                    idx_next.unsqueeze_(-1).expand(-1, -1, self.num_vq),
+                inputs_ids_buf.narrow(2, progress, 1).copy_(
+                    idx_next.unsqueeze_(1).expand(-1, num_vq, -1),
                 )
 
             if i == 0 and finish.any():
@@ -576,12 +705,14 @@ class GPT(nn.Module):
                         temperature,
                         attention_mask_cache,
                         past_key_values,
+                        cache_position,
+                        position_ids,
                         idx_next,
                         inputs_ids_buf,
                     )
                     new_gen = self.generate(
                         emb,
-                        inputs_ids,
+                        inputs_ids.permute(0, 2, 1),
                         old_temperature,
                         eos_token,
                         attention_mask,
@@ -603,14 +734,14 @@ class GPT(nn.Module):
                     del inputs_ids
                 return
 
-            del idx_next
             progress += 1
-            inputs_ids = inputs_ids_buf.narrow(1, 0, progress)
+            inputs_ids = inputs_ids_buf.narrow(2, 0, progress)
 
-            not_finished = finish.logical_not().to(end_idx.device)
+            not_finished = finish.logical_not()
             end_idx.add_(not_finished.int())
-            stream_iter += not_finished.any().int()
             if stream:
+                # only streaming needs to read the counters back every step
+                stream_iter += not_finished.any().int()
                 if stream_iter > 0 and stream_iter % stream_batch == 0:
                     self.logger.debug("yield stream result, end: %d", end_idx)
                     yield self._prepare_generation_outputs(
@@ -621,9 +752,10 @@ class GPT(nn.Module):
                         hiddens,
                         infer_text,
                     )
-            del not_finished
 
-            if finish.all() or context.get():
+            # finish.all() syncs with the device, so only check it every few steps.
+            # finished rows no longer advance end_idx, so overrunning is harmless
+            if context.get() or ((i + 1) % finish_check_interval == 0 and finish.all()):
                 break
 
             if pbar is not None:
@@ -640,7 +772,20 @@ class GPT(nn.Module):
                     f"incomplete result. hit max_new_token: {max_new_token}"
                 )
 
-        del finish, inputs_ids_buf
+        # the inputs of the last step still reference the kv cache
+        model_input = step_inputs = None
+        del (
+            finish,
+            inputs_ids_buf,
+            attention_mask_cache,
+            past_key_values,
+            cache_position,
+            position_ids,
+        )
+        if "cuda" in str(self.device_gpt):
+            # give the dynamic kv cache and the step buffers back once per
+            # generation, never inside the loop. a static cache is kept for reuse
+            torch.cuda.empty_cache()
 
         yield self._prepare_generation_outputs(
             inputs_ids,
@@ -0,0 +1,220 @@
+import os, sys
+
+if sys.platform == "darwin":
+    os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import logging
+import tempfile
+
+import torch
+import torch.nn.functional as F
+
+from ChatTTS.model import GPT
+
+from tools.logger import get_logger
+
+logger = get_logger("Test generate", lv=logging.WARN)
+
+"""
+smoke test of GPT.generate with a tiny random model,
+needs no downloaded assets and runs on cpu
+"""
+
+torch.manual_seed(0)
+
+num_text_tokens = 100
+num_audio_tokens = 16
+num_vq = 4
+max_new_token = 8
+
+gpt = GPT(
+    gpt_config={
+        "hidden_size": 64,
+        "intermediate_size": 128,
+        "num_attention_heads": 4,
+        "num_hidden_layers": 2,
+        "max_position_embeddings": 512,
+    },
+    num_audio_tokens=num_audio_tokens,
+    num_text_tokens=num_text_tokens,
+    num_vq=num_vq,
+    logger=logger,
+).eval()
+
+# checkpoint layout, copied as state_dict() shares storage with the parameters
+state_dict = {k: v.clone() for k, v in gpt.state_dict().items()}
+
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "GPT.pt")
+    torch.save(state_dict, path)
+    gpt.from_pretrained(path)
+gpt.prepare()
+
+# left padded batch, the last two positions of each row are audio codes
+input_ids = torch.randint(1, num_audio_tokens - 1, (2, 6, num_vq))
+attention_mask = torch.ones(2, 6, dtype=torch.long)
+attention_mask[1, 0] = 0
+text_mask = attention_mask.bool()
+text_mask[:, -2:] = False
+
+
+class EndOnFirstStep:
+    """
+    force eos for every row on the first call only,
+    so that ensure_non_empty has to regenerate
+    """
+
+    def __init__(self, eos_token: int):
+        self.eos_token = eos_token
+        self.called = False
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor):
+        if not self.called:
+            self.called = True
+            scores.fill_(-torch.inf)
+            scores[:, self.eos_token] = 0
+        return scores
+
+
+def eos_token_of(infer_text: bool) -> int:
+    return num_text_tokens - 1 if infer_text else num_audio_tokens - 1
+
+
+def run(infer_text: bool, **kwargs):
+    return gpt.generate(
+        gpt(input_ids, text_mask),
+        input_ids,
+        temperature=torch.tensor([0.7] * (1 if infer_text else num_vq)),
+        eos_token=eos_token_of(infer_text),
+        attention_mask=attention_mask,
+        max_new_token=max_new_token,
+        infer_text=infer_text,
+        return_hidden=not infer_text,
+        show_tqdm=False,
+        **kwargs,
+    )
+
+
+def check(result: GPT.GenerationOutputs, infer_text: bool) -> bool:
+    ok = True
+    for ids in result.ids:
+        if ids.size(0) > max_new_token or (not infer_text and ids.size(1) != num_vq):
+            logger.warning("unexpected ids shape %s", str(ids.shape))
+            ok = False
+    if not infer_text and len(result.hiddens) != len(result.ids):
+        logger.warning("missing hiddens")
+        ok = False
+    return ok
+
+
+def weight_normed(sd: dict, name: str) -> torch.Tensor:
+    g = sd[f"{name}.parametrizations.weight.original0"]
+    v = sd[f"{name}.parametrizations.weight.original1"]
+    return g * v / v.norm(dim=1, keepdim=True)
+
+
+def effective_weights(sd: dict) -> dict:
+    """
+    the weights a state_dict stands for, g and v of weight_norm
+    are only defined up to a scale
+    """
+    suffix = ".parametrizations.weight.original1"
+    weights = {k: v for k, v in sd.items() if ".parametrizations." not in k}
+    for k in sd:
+        if k.endswith(suffix):
+            name = k[: -len(suffix)]
+            weights[name] = weight_normed(sd, name)
+    return weights
+
+
+fail = False
+
+# get_emb picks the text embedding or the sum of the num_vq code embeddings
+emb_ref = torch.zeros(*input_ids.shape[:-1], gpt.model_dim)
+emb_ref[text_mask] = F.embedding(
+    input_ids[text_mask][:, 0], state_dict["emb_text.weight"]
+)
+emb_ref[~text_mask] = sum(
+    F.embedding(input_ids[~text_mask][:, i], state_dict[f"emb_code.{i}.weight"])
+    for i in range(num_vq)
+)
+with torch.no_grad():
+    if not torch.allclose(gpt(input_ids, text_mask), emb_ref, atol=1e-6):
+        logger.warning("get_emb mismatch")
+        fail = True
+
+# the fused code table gives the sum of the per vq lookups
+code_ref = sum(
+    F.embedding(input_ids[..., i], state_dict[f"emb_code.{i}.weight"])
+    for i in range(num_vq)
+)
+with torch.no_grad():
+    if not torch.allclose(gpt._emb_code(input_ids), code_ref, atol=1e-6):
+        logger.warning("fused code embedding mismatch")
+        fail = True
+
+# the heads hold the weight-normed weights, the code heads stacked
+hidden = torch.randn(input_ids.size(0), gpt.model_dim)
+head_ref = torch.stack(
+    [
+        F.linear(hidden, weight_normed(state_dict, f"head_code.{i}"))
+        for i in range(num_vq)
+    ],
+    1,
+)
+with torch.no_grad():
+    logits = gpt.head_code_fused(hidden).view(-1, num_vq, num_audio_tokens)
+    if not torch.allclose(logits, head_ref, atol=1e-5):
+        logger.warning("fused code head mismatch")
+        fail = True
+    logits = gpt.head_text(hidden)
+    if not torch.allclose(
+        logits, F.linear(hidden, weight_normed(state_dict, "head_text")), atol=1e-5
+    ):
+        logger.warning("text head mismatch")
+        fail = True
+
+# state_dict keeps the checkpoint layout and loads again
+reloaded = gpt.state_dict()
+expected, actual = effective_weights(state_dict), effective_weights(reloaded)
+if set(reloaded) != set(state_dict) or any(
+    not torch.allclose(actual[k], v, atol=1e-6) for k, v in expected.items()
+):
+    logger.warning("state_dict does not match the checkpoint")
+    fail = True
+gpt.load_state_dict(reloaded)
+
+for infer_text in (True, False):
+    result = next(run(infer_text, ensure_non_empty=False))
+    fail |= not check(result, infer_text)
+    result.destroy()
+
+    # streaming yields growing prefixes of the final result
+    lengths = [0] * input_ids.size(0)
+    for result in run(infer_text, ensure_non_empty=False, stream=True, stream_batch=2):
+        fail |= not check(result, infer_text)
+        for idx, ids in enumerate(result.ids):
+            if ids.size(0) < lengths[idx]:
+                logger.warning("stream result shrinks at row %d", idx)
+                fail = True
+            lengths[idx] = ids.size(0)
+
+    # an eos on the first step must be regenerated
+    result = next(
+        run(
+            infer_text,
+            ensure_non_empty=True,
+            logits_warpers=[EndOnFirstStep(eos_token_of(infer_text))],
+        )
+    )
+    fail |= not check(result, infer_text)
+    if any(ids.size(0) == 0 for ids in result.ids):
+        logger.warning("ensure_non_empty returned an empty result")
+        fail = True
+    result.destroy()
+
+if fail:
+    sys.exit(1)